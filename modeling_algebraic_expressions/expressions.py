@@ -1,38 +1,210 @@
 # Guided by Paul Orlean's "Math for Programmers" book.
 from abc import ABC, abstractmethod
+import hashlib
+import importlib.util
 import math
+import numbers
+import operator
+import os
+import stat
+import warnings
+import weakref
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+try:
+  import numba
+except ImportError:
+  numba = None
+
+try:
+  from pyximport import pyxbuild
+except ImportError:
+  pyxbuild = None
 
 class Expression(ABC):
+  __slots__ = ("var_mask", "is_expanded", "_expanded", "is_simplified", "_simplified", "_schedule", "_collected", "_derivatives", "_hash", "__weakref__")
+
+  def __new__(cls, *args, **kwargs):
+    self = super().__new__(cls)
+    self.is_expanded = False
+    self._expanded = None
+    self.is_simplified = False
+    self._simplified = None
+    self._schedule = None
+    self._collected = None
+    self._derivatives = None
+    self._hash = None
+    return self
+
+  is_atomic = False
+
   @abstractmethod
   def __str__(self):
     pass
 
+  @classmethod
+  def of(cls, *args):
+    key = (cls, cls._key_of(*args))
+    node = _INTERNED.get(key)
+    if node is None:
+      node = _INTERNED[key] = cls(*args)
+    return node
+
+  @classmethod
+  def _key_of(cls, *args):
+    return args
+
+  def __eq__(self, other):
+    return self is other or (type(self) is type(other) and self._key() == other._key())
+
+  def __hash__(self):
+    if self._hash is None:
+      self._hash = hash((type(self), self._key()))
+    return self._hash
+
   @abstractmethod
-  def evaluate(self, **bindings):
+  def _key(self):
     pass
 
+  def compile(self):
+    return compile_schedule(self)
+
+  def evaluate(self, **bindings):
+    return self.compile()(**bindings)
+
+  def evaluate_array(self, **arrays):
+    return self.compile().evaluate_array(**arrays)
+
+  def to_jit(self, variables):
+    return compile_jit(self, variables)
+
+  def to_c_extension(self, variables):
+    return compile_cython(self, variables)
+
+  def bind(self, variables):
+    program = self.compile()
+    positions = {name: position for position, name in enumerate(variables)}
+    schedule = []
+    for slot, op, arg, left, right in program.schedule:
+      if op == LOAD_VAR:
+        try:
+          op, arg = LOAD_LOCAL, positions[arg]
+        except KeyError:
+          raise ValueError(f"Variable {arg} is not bound to a value")
+      schedule.append((slot, op, arg, left, right))
+    return BoundExpression(schedule, program.values, program.result, variables)
+
   @abstractmethod
-  def expand(self):
+  def _children(self):
     pass
 
+  def expand(self):
+    if self.is_expanded:
+      return self
+    if self._expanded is None:
+      expanded = self._expand().simplify()
+      if expanded is not self:
+        expanded = expanded.expand()
+      expanded.is_expanded = True
+      if expanded is self:
+        return self
+      self._expanded = expanded
+    return self._expanded
+
+  def distribute_left(self, other, operation, combine=None):
+    return None
+
+  def distribute_right(self, other, operation, combine=None):
+    return None
+
   @abstractmethod
-  def derivative(self, variable):
+  def _expand(self):
     pass
 
+  def derivative(self, variable):
+    return self._derivative_by_id(_symbol_id(variable))
+
+  def _derivative_by_id(self, variable):
+    if variable < 0 or not (self.var_mask >> variable) & 1:
+      return NUMBER_ZERO
+    if self._derivatives is None:
+      self._derivatives = {}
+    result = self._derivatives.get(variable)
+    if result is None:
+      result = self._derivatives[variable] = self._derivative(variable).simplify()
+    return result
+
   @abstractmethod
-  def get_distinct_variables(self):
+  def _derivative(self, variable):
     pass
 
+  def simplify(self):
+    if self.is_simplified:
+      return self
+    if self._simplified is None:
+      simplified = self._simplify()
+      simplified.is_simplified = True
+      if simplified is self:
+        return self
+      self._simplified = simplified
+    return self._simplified
+
   @abstractmethod
-  def get_distinct_numbers(self):
+  def _simplify(self):
     pass
 
-  @abstractmethod
-  def get_distinct_functions(self):
+  def _walk(self):
+    seen = set()
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      if id(node) in seen:
+        continue
+      seen.add(id(node))
+      yield node
+      stack.extend(node._children())
+
+  def collect_all(self):
+    if self._collected is None:
+      variables, numbers, functions = set(), set(), set()
+      for node in self._walk():
+        node._collect(variables, numbers, functions)
+      self._collected = (frozenset(variables), frozenset(numbers), frozenset(functions))
+    return self._collected
+
+  def _collect(self, vars_out, nums_out, fns_out):
     pass
 
+  def get_distinct_variables(self):
+    return set(self.collect_all()[0])
+
+  def get_distinct_numbers(self):
+    return set(self.collect_all()[1])
+
+  def get_distinct_functions(self):
+    return set(self.collect_all()[2])
+
   def contains(self, variable):
-    return variable in self.get_distinct_variables()
+    variable = _symbol_id(variable)
+    return variable >= 0 and bool((self.var_mask >> variable) & 1)
+
+
+_SYMBOL_TABLE = {}
+
+
+def _symbol_id(variable):
+  if isinstance(variable, Variable):
+    return variable.id
+  if isinstance(variable, str):
+    return _SYMBOL_TABLE.get(variable, -1)
+  raise TypeError("variable must be a name or an instance of Variable")
+
+
+_INTERNED = weakref.WeakValueDictionary()
 
 
 _SPECIAL_FUNCTIONS_BINDING = {
@@ -59,287 +231,867 @@ _SPECIAL_FUNCTIONS_BINDING = {
 }
 
 
+if np is not None:
+  _NUMPY_FUNCTIONS_BINDING = {
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "asin": np.arcsin,
+    "acos": np.arccos,
+    "atan": np.arctan,
+    "atan2": np.arctan2,
+    "sinh": np.sinh,
+    "cosh": np.cosh,
+    "tanh": np.tanh,
+    "asinh": np.arcsinh,
+    "acosh": np.arccosh,
+    "atanh": np.arctanh,
+    "exp": np.exp,
+    "ln": np.log,
+    "log": np.log10,
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "ceil": np.ceil,
+    "floor": np.floor,
+  }
+else:
+  _NUMPY_FUNCTIONS_BINDING = None
+
+
+def _is_number(expression, value):
+  return isinstance(expression, Number) and expression.value == value
+
+
+def _fold(operation, *operands):
+  try:
+    return Number.of(operation(*(operand.value for operand in operands)))
+  except (ArithmeticError, TypeError, ValueError):
+    return None
+
+
+LOAD_CONST = 0
+LOAD_VAR = 1
+ADD = 2
+SUB = 3
+MUL = 4
+DIV = 5
+NEG = 6
+ABS = 7
+POW = 8
+SQRT = 9
+MOD = 10
+CALL_FN = 11
+LOAD_LOCAL = 12
+
+
+_OPCODE_SOURCE = {
+  ADD: "({0} + {1})",
+  SUB: "({0} - {1})",
+  MUL: "({0} * {1})",
+  DIV: "({0} / {1})",
+  NEG: "(-{0})",
+  ABS: "abs({0})",
+  POW: "({0} ** {1})",
+  SQRT: "sqrt({0})",
+  MOD: "({0} % {1})",
+}
+
+
+class ScheduledExpression():
+  __slots__ = ("schedule", "values", "result")
+
+  def __init__(self, schedule, values, result):
+    self.schedule = tuple(schedule)
+    self.values = tuple(values)
+    self.result = result
+
+  def __call__(self, **bindings):
+    return self._run(bindings, _SPECIAL_FUNCTIONS_BINDING)
+
+  def evaluate_array(self, **arrays):
+    if np is None:
+      raise ImportError("evaluate_array requires numpy")
+    arrays = {name: np.asarray(array, dtype=float) for name, array in arrays.items()}
+    return self._run_array(arrays, arrays.values())
+
+  def _run_array(self, bindings, arrays):
+    result = self._run(bindings, _NUMPY_FUNCTIONS_BINDING)
+    return np.broadcast_to(result, np.broadcast_shapes(*(array.shape for array in arrays))).astype(float)
+
+  def _run(self, bindings, functions):
+    sqrt = functions["sqrt"]
+    values = list(self.values)
+    for slot, op, arg, left, right in self.schedule:
+      if op == LOAD_LOCAL:
+        values[slot] = bindings[arg]
+      elif op == LOAD_VAR:
+        try:
+          values[slot] = bindings[arg]
+        except KeyError:
+          raise ValueError(f"Variable {arg} is not bound to a value")
+      elif op == ADD:
+        values[slot] = values[left] + values[right]
+      elif op == MUL:
+        values[slot] = values[left] * values[right]
+      elif op == SUB:
+        values[slot] = values[left] - values[right]
+      elif op == DIV:
+        values[slot] = values[left] / values[right]
+      elif op == POW:
+        values[slot] = values[left] ** values[right]
+      elif op == CALL_FN:
+        values[slot] = functions[arg](values[left])
+      elif op == NEG:
+        values[slot] = -values[left]
+      elif op == ABS:
+        values[slot] = abs(values[left])
+      elif op == SQRT:
+        values[slot] = sqrt(values[left])
+      elif op == MOD:
+        values[slot] = values[left] % values[right]
+    return values[self.result]
+
+
+class BoundExpression(ScheduledExpression):
+  __slots__ = ("variables",)
+
+  def __init__(self, schedule, values, result, variables):
+    super().__init__(schedule, values, result)
+    self.variables = tuple(variables)
+
+  def __call__(self, *args):
+    if len(args) != len(self.variables):
+      raise TypeError(f"expected {len(self.variables)} arguments, got {len(args)}")
+    return self._run(args, _SPECIAL_FUNCTIONS_BINDING)
+
+  def evaluate(self, **bindings):
+    try:
+      args = [bindings[name] for name in self.variables]
+    except KeyError as error:
+      raise ValueError(f"Variable {error.args[0]} is not bound to a value")
+    return self._run(args, _SPECIAL_FUNCTIONS_BINDING)
+
+  def evaluate_array(self, **arrays):
+    try:
+      args = [arrays[name] for name in self.variables]
+    except KeyError as error:
+      raise ValueError(f"Variable {error.args[0]} is not bound to a value")
+    return self.call_array(*args)
+
+  def call_array(self, *arrays):
+    if np is None:
+      raise ImportError("call_array requires numpy")
+    if len(arrays) != len(self.variables):
+      raise TypeError(f"expected {len(self.variables)} arguments, got {len(arrays)}")
+    arrays = [np.asarray(array, dtype=float) for array in arrays]
+    return self._run_array(arrays, arrays)
+
+
+def compile_schedule(root):
+  if root._schedule is not None:
+    return root._schedule
+  slots = {}
+  values = []
+  schedule = []
+
+  def allocate(value=None):
+    values.append(value)
+    return len(values) - 1
+
+  def visit(node):
+    slot = slots.get(node)
+    if slot is not None:
+      return slot
+    operands = [visit(child) for child in node._children()]
+    opcode = node._opcode
+    if opcode == LOAD_CONST:
+      slot = allocate(node.value)
+    elif opcode == LOAD_VAR:
+      slot = allocate()
+      schedule.append((slot, LOAD_VAR, node.name, None, None))
+    elif opcode == ADD:
+      slot = operands[0] if operands else allocate(0)
+      for operand in operands[1:]:
+        total = allocate()
+        schedule.append((total, ADD, None, slot, operand))
+        slot = total
+    elif opcode == CALL_FN:
+      slot = allocate()
+      schedule.append((slot, CALL_FN, node.function.name, operands[0], None))
+    else:
+      slot = allocate()
+      schedule.append((slot, opcode, None, operands[0], operands[1] if len(operands) > 1 else None))
+    slots[node] = slot
+    return slot
+
+  root._schedule = ScheduledExpression(schedule, values, visit(root))
+  return root._schedule
+
+
+_JIT_CACHE = weakref.WeakKeyDictionary()
+
+
+def compile_jit(root, variables):
+  variables = tuple(variables)
+  functions = _JIT_CACHE.setdefault(root, {})
+  function = functions.get(variables)
+  if function is None:
+    if numba is not None:
+      namespace = dict(_NUMPY_FUNCTIONS_BINDING)
+    else:
+      namespace = dict(_SPECIAL_FUNCTIONS_BINDING)
+    namespace["math"] = math
+    exec(_schedule_source(compile_schedule(root), variables), namespace)
+    function = namespace["_f"]
+    if numba is not None:
+      function = numba.njit(function)
+    functions[variables] = function
+  return function
+
+
+_PYTHON_FUNCTIONS = {name: name for name in _SPECIAL_FUNCTIONS_BINDING}
+
+
+def _schedule_source(program, variables):
+  arguments, assignments, result = _schedule_assignments(program, variables, _OPCODE_SOURCE, _PYTHON_FUNCTIONS, "math.inf", "math.nan")
+  lines = [f"def _f({', '.join(arguments)}):"]
+  lines.extend(f"  {name} = {expression}" for name, expression in assignments)
+  lines.append(f"  return {result}")
+  return "\n".join(lines)
+
+
+_C_OPCODE_SOURCE = {
+  **_OPCODE_SOURCE,
+  ABS: "fabs({0})",
+  POW: "pow({0}, {1})",
+}
+
+
+_C_FUNCTIONS = {
+  "sin": "sin",
+  "cos": "cos",
+  "tan": "tan",
+  "asin": "asin",
+  "acos": "acos",
+  "atan": "atan",
+  "sinh": "sinh",
+  "cosh": "cosh",
+  "tanh": "tanh",
+  "asinh": "asinh",
+  "acosh": "acosh",
+  "atanh": "atanh",
+  "exp": "exp",
+  "ln": "log",
+  "log": "log10",
+  "sqrt": "sqrt",
+  "abs": "fabs",
+  "ceil": "ceil",
+  "floor": "floor",
+}
+
+
+_CYTHON_CACHE = weakref.WeakKeyDictionary()
+
+
+def compile_cython(root, variables):
+  variables = tuple(variables)
+  functions = _CYTHON_CACHE.setdefault(root, {})
+  function = functions.get(variables)
+  if function is None:
+    source = _schedule_cython_source(compile_schedule(root), variables)
+    if pyxbuild is None:
+      function = root.bind(variables)
+    else:
+      try:
+        function = _build_cython(source)
+      except Exception as error:
+        warnings.warn(f"Cython compilation failed, falling back to bind(): {error}", RuntimeWarning)
+        function = root.bind(variables)
+    functions[variables] = function
+  return function
+
+
+def _cython_cache_directory():
+  base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  directory = os.path.join(base, "calculus_cython")
+  os.makedirs(directory, mode=0o700, exist_ok=True)
+  status = os.lstat(directory)
+  if (
+    not stat.S_ISDIR(status.st_mode)
+    or (hasattr(os, "getuid") and status.st_uid != os.getuid())
+    or status.st_mode & 0o077
+  ):
+    raise PermissionError(f"{directory} is not a directory private to the current user")
+  return directory
+
+
+def _build_cython(source):
+  name = "_expression_" + hashlib.sha1(source.encode()).hexdigest()
+  directory = _cython_cache_directory()
+  path = os.path.join(directory, name + ".pyx")
+  try:
+    with open(path) as file:
+      current = file.read()
+  except FileNotFoundError:
+    current = None
+  if current != source:
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as file:
+      file.write(source)
+    os.replace(temporary, path)
+  library = pyxbuild.pyx_to_dll(path, pyxbuild_dir=os.path.join(directory, "build"))
+  spec = importlib.util.spec_from_file_location(name, library)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module.eval_expr
+
+
+def _schedule_cython_source(program, variables):
+  arguments, assignments, result = _schedule_assignments(program, variables, _C_OPCODE_SOURCE, _C_FUNCTIONS, "INFINITY", "NAN")
+  lines = [
+    "# cython: language_level=3",
+    f"from libc.math cimport {', '.join(sorted(set(_C_FUNCTIONS.values()) | {'pow', 'INFINITY', 'NAN'}))}",
+    "",
+    f"cpdef double eval_expr({', '.join(f'double {argument}' for argument in arguments)}):",
+  ]
+  lines.extend(f"  cdef double {name} = {expression}" for name, expression in assignments)
+  lines.append(f"  return {result}")
+  return "\n".join(lines)
+
+
+def _schedule_literal(value, infinity, nan):
+  if isinstance(value, numbers.Integral):
+    return f"({int(value)!r})"
+  if not isinstance(value, numbers.Real):
+    raise ValueError(f"Number {value!r} is not a real number")
+  value = float(value)
+  if not math.isfinite(value):
+    if math.isnan(value):
+      return nan
+    return infinity if value > 0 else f"(-{infinity})"
+  return f"({value!r})"
+
+
+def _schedule_assignments(program, variables, templates, functions, infinity, nan):
+  arguments = {name: f"_v{index}" for index, name in enumerate(variables)}
+  operands = [None if value is None else _schedule_literal(value, infinity, nan) for value in program.values]
+  assignments = []
+  for slot, op, arg, left, right in program.schedule:
+    if op == LOAD_VAR:
+      try:
+        operands[slot] = arguments[arg]
+      except KeyError:
+        raise ValueError(f"Variable {arg} is not bound to a value")
+      continue
+    if op == CALL_FN:
+      try:
+        expression = f"{functions[arg]}({operands[left]})"
+      except KeyError:
+        raise ValueError(f"Function {arg} cannot be compiled")
+    elif right is None:
+      expression = templates[op].format(operands[left])
+    else:
+      expression = templates[op].format(operands[left], operands[right])
+    assignments.append((f"_t{slot}", expression))
+    operands[slot] = f"_t{slot}"
+  return list(arguments.values()), assignments, operands[program.result]
+
+
 class Power(Expression):
+  __slots__ = ("base", "exponent")
+  _opcode = POW
+
   def __init__(self, base, exponent):
     self.base = base
     self.exponent = exponent
+    self.var_mask = base.var_mask | exponent.var_mask
 
-  def evaluate(self, **bindings):
-    return self.base.evaluate(**bindings) ** self.exponent.evaluate(**bindings)
-  
-  def expand(self):
-    expaded_base = self.base.expand()
-    expanded_exponent = self.exponent.expand()
+  def __str__(self):
+    return f"({self.base} ** {self.exponent})"
 
-    if isinstance(expaded_base, Sum):
-      return Sum(*[Power(term, self.exponent).expand() for term in expaded_base.terms])
-    
-    if isinstance(expanded_exponent, Sum):
-      return Product(*[Power(self.base, term).expand() for term in expanded_exponent.terms])
+  def _key(self):
+    return (self.base, self.exponent)
+
+  def _children(self):
+    return (self.base, self.exponent)
+
+  def _expand(self):
+    expanded_base = self.base if self.base.is_atomic else self.base.expand()
+    expanded_exponent = self.exponent if self.exponent.is_atomic else self.exponent.expand()
+
+    distributed = expanded_base.distribute_left(expanded_exponent, Power.of)
+    if distributed is None:
+      distributed = expanded_exponent.distribute_right(expanded_base, Power.of, Product.of)
+    if distributed is not None:
+      return distributed._expand()
     
-    return Power(expaded_base, expanded_exponent)
+    return Power.of(expanded_base, expanded_exponent)
   
-  def derivative(self, variable):
-    return Product(self.exponent, Power(self.base, Difference(self.exponent, Number(1))), self.base.derivative(variable))
-  
-  def get_distinct_functions(self):
-    return self.base.get_distinct_functions().union(self.exponent.get_distinct_functions())
-  
-  def get_distinct_numbers(self):
-    return self.base.get_distinct_numbers().union(self.exponent.get_distinct_numbers())
-  
-  def get_distinct_variables(self):
-    return self.base.get_distinct_variables().union(self.exponent.get_distinct_variables())
+  def _derivative(self, variable):
+    derivative = Product.of(Product.of(self.exponent, Power.of(self.base, Difference.of(self.exponent, NUMBER_ONE))), self.base._derivative_by_id(variable))
+    if not (self.exponent.var_mask >> variable) & 1:
+      return derivative
+    return Sum.of(derivative, Product.of(Product.of(self, Apply.of(Function("ln"), self.base)), self.exponent._derivative_by_id(variable)))
   
+  def _simplify(self):
+    base = self.base.simplify()
+    exponent = self.exponent.simplify()
+    if isinstance(base, Number) and isinstance(exponent, Number):
+      folded = _fold(operator.pow, base, exponent)
+      if folded is not None:
+        return folded
+    if _is_number(exponent, 0):
+      return NUMBER_ONE
+    if _is_number(exponent, 1):
+      return base
+    if _is_number(exponent, 2) and isinstance(base, SquareRoot):
+      return base.expression
+    return Power.of(base, exponent)
+
 
 class Number(Expression):
+  __slots__ = ("value",)
+  is_atomic = True
+  _opcode = LOAD_CONST
+
   def __init__(self, value):
     self.value = value
+    self.var_mask = 0
 
-  def evaluate(self, **bindings):
-    return self.value
-  
-  def expand(self):
+  def __str__(self):
+    return str(self.value)
+
+  def _key(self):
+    return Number._key_of(self.value)
+
+  @classmethod
+  def _key_of(cls, value):
+    if isinstance(value, float):
+      return (float, value, math.copysign(1.0, value))
+    return (type(value), value)
+
+  def _children(self):
+    return ()
+
+  def _collect(self, vars_out, nums_out, fns_out):
+    nums_out.add(self.value)
+
+  def _expand(self):
     return self
   
-  def derivative(self, variable):
-    return Number(0)
-  
-  def get_distinct_functions(self):
-    return set()
-  
-  def get_distinct_numbers(self):
-    return {self.value}
+  def _derivative(self, variable):
+    return NUMBER_ZERO
+
+  _derivative_by_id = _derivative
   
-  def get_distinct_variables(self):
-    return set()
+  def _simplify(self):
+    return self
+
+  simplify = _simplify
+
+
+NUMBER_ZERO = Number.of(0)
+NUMBER_ONE = Number.of(1)
+
 
 class Variable(Expression):
+  __slots__ = ("name", "id")
+  is_atomic = True
+  _opcode = LOAD_VAR
+
   def __init__(self, name):
     self.name = name
+    self.id = _SYMBOL_TABLE.setdefault(name, len(_SYMBOL_TABLE))
+    self.var_mask = 1 << self.id
 
-  def evaluate(self, **bindings):
-    try:
-      return bindings[self.name]
-    except KeyError:
-      raise ValueError(f"Variable {self.name} is not bound to a value")
-    
-  def expand(self):
+  def __str__(self):
+    return self.name
+
+  def _key(self):
+    return (self.name,)
+
+  def _children(self):
+    return ()
+
+  def _collect(self, vars_out, nums_out, fns_out):
+    vars_out.add(self.name)
+
+  def _expand(self):
     return self
   
-  def derivative(self, variable):
-    if self.name == variable:
-      return Number(1)
+  def _derivative(self, variable):
+    if self.id == variable:
+      return NUMBER_ONE
     else:
-      return Number(0)
+      return NUMBER_ZERO
+
+  _derivative_by_id = _derivative
     
-  def get_distinct_functions(self):
-    return set()
-  
-  def get_distinct_numbers(self):
-    return set()
-  
-  def get_distinct_variables(self):
-    return {self.name}
-  
+  def _simplify(self):
+    return self
+
+  simplify = _simplify
+
 
 class Product(Expression):
+  __slots__ = ("factor1", "factor2")
+  _opcode = MUL
+
   def __init__(self, factor1, factor2):
     self.factor1 = factor1
     self.factor2 = factor2
+    self.var_mask = factor1.var_mask | factor2.var_mask
 
-  def evaluate(self, **bindings):
-    return self.factor1.evaluate(**bindings) * self.factor2.evaluate(**bindings)
-  
-  def expand(self):
-    expanded_factor1 = self.factor1.expand()
-    expanded_factor2 = self.factor2.expand()
+  @classmethod
+  def of(cls, *factors):
+    if len(factors) == 2:
+      return super().of(*factors)
+    if len(factors) < 2:
+      return factors[0] if factors else NUMBER_ONE
+    middle = len(factors) // 2
+    return super().of(cls.of(*factors[:middle]), cls.of(*factors[middle:]))
 
-    if isinstance(expanded_factor1, Sum):
-      return Sum(*[Product(term, self.factor2).expand() for term in expanded_factor1.terms])
-    
-    if isinstance(expanded_factor2, Sum):
-      return Sum(*[Product(self.factor1, term).expand() for term in expanded_factor2.terms])
+  def __str__(self):
+    return f"({self.factor1} * {self.factor2})"
+
+  def _key(self):
+    return (self.factor1, self.factor2)
+
+  def _children(self):
+    return (self.factor1, self.factor2)
+
+  def _expand(self):
+    expanded_factor1 = self.factor1 if self.factor1.is_atomic else self.factor1.expand()
+    expanded_factor2 = self.factor2 if self.factor2.is_atomic else self.factor2.expand()
+
+    distributed = expanded_factor1.distribute_left(expanded_factor2, Product.of)
+    if distributed is None:
+      distributed = expanded_factor2.distribute_right(expanded_factor1, Product.of)
+    if distributed is not None:
+      return distributed._expand()
     
-    return Product(expanded_factor1, expanded_factor2)
+    return Product.of(expanded_factor1, expanded_factor2)
   
-  def derivative(self, variable):
-    return Sum(Product(self.factor1, self.factor2.derivative(variable)), Product(self.factor1.derivative(variable), self.factor2))
-  
-  def get_distinct_functions(self):
-    return self.factor1.get_distinct_functions().union(self.factor2.get_distinct_functions())
-  
-  def get_distinct_numbers(self):
-    return self.factor1.get_distinct_numbers().union(self.factor2.get_distinct_numbers())
+  def _derivative(self, variable):
+    return Sum.of(Product.of(self.factor1, self.factor2._derivative_by_id(variable)), Product.of(self.factor1._derivative_by_id(variable), self.factor2))
   
-  def get_distinct_variables(self):
-    return self.factor1.get_distinct_variables().union(self.factor2.get_distinct_variables())
+  def _simplify(self):
+    coefficient = 1
+    factors = []
+    roots = []
+    for factor in (self.factor1.simplify(), self.factor2.simplify()):
+      for sub_factor in factor._factors() if isinstance(factor, Product) else (factor,):
+        if isinstance(sub_factor, Number):
+          coefficient *= sub_factor.value
+        elif isinstance(sub_factor, SquareRoot):
+          roots.append(sub_factor.expression)
+        else:
+          factors.append(sub_factor)
+    if len(roots) > 1:
+      unpaired = []
+      for root in roots:
+        if root in unpaired:
+          unpaired.remove(root)
+          factors.append(root)
+        else:
+          unpaired.append(root)
+      if unpaired:
+        factors.append(SquareRoot.of(Product.of(*unpaired)))
+      return Product.of(Number.of(coefficient), *factors).simplify()
+    factors.extend(SquareRoot.of(root) for root in roots)
+    if coefficient == 0 or not factors:
+      return Number.of(coefficient)
+    if coefficient != 1:
+      factors.insert(0, Number.of(coefficient))
+    return Product.of(*factors)
+
+  def _factors(self):
+    factors = []
+    for factor in (self.factor1, self.factor2):
+      if isinstance(factor, Product):
+        factors.extend(factor._factors())
+      else:
+        factors.append(factor)
+    return factors
 
 
 class Quotient(Expression):
+  __slots__ = ("numerator", "denominator")
+  _opcode = DIV
+
   def __init__(self, numerator, denominator):
     self.numerator = numerator
     self.denominator = denominator
+    self.var_mask = numerator.var_mask | denominator.var_mask
 
-  def evaluate(self, **bindings):
-    return self.numerator.evaluate(**bindings) / self.denominator.evaluate(**bindings)
-  
-  def expand(self):
-    expanded_numerator = self.numerator.expand()
-    expanded_denominator = self.denominator.expand()
+  def __str__(self):
+    return f"({self.numerator} / {self.denominator})"
 
-    if isinstance(expanded_numerator, Sum):
-      return Sum(*[Quotient(term, self.denominator).expand() for term in expanded_numerator.terms])
-    
-    if isinstance(expanded_denominator, Sum):
-      return Sum(*[Quotient(self.numerator, term).expand() for term in expanded_denominator.terms])
+  def _key(self):
+    return (self.numerator, self.denominator)
+
+  def _children(self):
+    return (self.numerator, self.denominator)
+
+  def _expand(self):
+    expanded_numerator = self.numerator if self.numerator.is_atomic else self.numerator.expand()
+    expanded_denominator = self.denominator if self.denominator.is_atomic else self.denominator.expand()
+
+    distributed = expanded_numerator.distribute_left(expanded_denominator, Quotient.of)
+    if distributed is None:
+      distributed = expanded_denominator.distribute_right(expanded_numerator, Quotient.of)
+    if distributed is not None:
+      return distributed._expand()
     
-    return Quotient(expanded_numerator, expanded_denominator)
-  
-  def derivative(self, variable):
-    return Quotient(Difference(Product(self.numerator.derivative(variable), self.denominator), Product(self.numerator, self.denominator.derivative(variable))), Power(self.denominator, Number(2)))
-  
-  def get_distinct_functions(self):
-    return self.numerator.get_distinct_functions().union(self.denominator.get_distinct_functions())
+    return Quotient.of(expanded_numerator, expanded_denominator)
   
-  def get_distinct_numbers(self):
-    return self.numerator.get_distinct_numbers().union(self.denominator.get_distinct_numbers())
+  def _derivative(self, variable):
+    return Quotient.of(Difference.of(Product.of(self.numerator._derivative_by_id(variable), self.denominator), Product.of(self.numerator, self.denominator._derivative_by_id(variable))), Power.of(self.denominator, Number.of(2)))
   
-  def get_distinct_variables(self):
-    return self.numerator.get_distinct_variables().union(self.denominator.get_distinct_variables())
+  def _simplify(self):
+    numerator = self.numerator.simplify()
+    denominator = self.denominator.simplify()
+    if isinstance(numerator, Number) and isinstance(denominator, Number):
+      folded = _fold(operator.truediv, numerator, denominator)
+      if folded is not None:
+        return folded
+    if _is_number(denominator, 1):
+      return numerator
+    if _is_number(numerator, 0) and not _is_number(denominator, 0):
+      return NUMBER_ZERO
+    return Quotient.of(numerator, denominator)
 
 
 class Sum(Expression):
+  __slots__ = ("terms",)
+  _opcode = ADD
+
   def __init__(self, *terms):
     self.terms = terms
+    self.var_mask = 0
+    for term in terms:
+      self.var_mask |= term.var_mask
 
-  def evaluate(self, **bindings):
-    return sum(term.evaluate(**bindings) for term in self.terms)
-  
-  def expand(self):
-    return Sum(*[term.expand() for term in self.terms])
-  
-  def derivative(self, variable):
-    return Sum(*[term.derivative(variable) for term in self.terms])
-  
-  def get_distinct_functions(self):
-    return set().union(*(term.get_distinct_functions() for term in self.terms))
+  @classmethod
+  def of(cls, *terms):
+    flattened = []
+    for term in terms:
+      if isinstance(term, Sum):
+        flattened.extend(term.terms)
+      else:
+        flattened.append(term)
+    return super().of(*flattened)
+
+  def __str__(self):
+    return "(" + " + ".join(str(term) for term in self.terms) + ")" if self.terms else "0"
+
+  def _key(self):
+    return self.terms
+
+  def _children(self):
+    return self.terms
+
+  def _expand(self):
+    return Sum.of(*[term if term.is_atomic else term.expand() for term in self.terms])
+
+  def distribute_left(self, other, operation, combine=None):
+    return (combine or Sum.of)(*[operation(term, other) for term in self.terms])
+
+  def distribute_right(self, other, operation, combine=None):
+    return (combine or Sum.of)(*[operation(other, term) for term in self.terms])
   
-  def get_distinct_numbers(self):
-    return set().union(*(term.get_distinct_numbers() for term in self.terms))
+  def _derivative(self, variable):
+    return Sum.of(*[term._derivative_by_id(variable) for term in self.terms])
   
-  def get_distinct_variables(self):
-    return set().union(*(term.get_distinct_variables() for term in self.terms))
+  def _simplify(self):
+    constant = 0
+    terms = []
+    for term in self.terms:
+      term = term.simplify()
+      for sub_term in term.terms if isinstance(term, Sum) else (term,):
+        if isinstance(sub_term, Number):
+          constant += sub_term.value
+        else:
+          terms.append(sub_term)
+    if not terms:
+      return Number.of(constant)
+    if constant != 0:
+      terms.append(Number.of(constant))
+    if len(terms) == 1:
+      return terms[0]
+    return Sum.of(*terms)
 
 class Difference(Expression):
+  __slots__ = ("minuend", "subtrahend")
+  _opcode = SUB
+
   def __init__(self, minuend, subtrahend):
     self.minuend = minuend
     self.subtrahend = subtrahend
+    self.var_mask = minuend.var_mask | subtrahend.var_mask
 
-  def evaluate(self, **bindings):
-    return self.minuend.evaluate(**bindings) - self.subtrahend.evaluate(**bindings)
-  
-  def expand(self):
-    return Difference(self.minuend.expand(), self.subtrahend.expand())
-  
-  def derivative(self, variable):
-    return Difference(self.minuend.derivative(variable), self.subtrahend.derivative(variable))
-  
-  def get_distinct_functions(self):
-    return self.minuend.get_distinct_functions().union(self.subtrahend.get_distinct_functions())
+  def __str__(self):
+    return f"({self.minuend} - {self.subtrahend})"
+
+  def _key(self):
+    return (self.minuend, self.subtrahend)
+
+  def _children(self):
+    return (self.minuend, self.subtrahend)
+
+  def _expand(self):
+    return Difference.of(self.minuend if self.minuend.is_atomic else self.minuend.expand(), self.subtrahend if self.subtrahend.is_atomic else self.subtrahend.expand())
   
-  def get_distinct_numbers(self):
-    return self.minuend.get_distinct_numbers().union(self.subtrahend.get_distinct_numbers())
+  def _derivative(self, variable):
+    return Difference.of(self.minuend._derivative_by_id(variable), self.subtrahend._derivative_by_id(variable))
   
-  def get_distinct_variables(self):
-    return self.minuend.get_distinct_variables().union(self.subtrahend.get_distinct_variables())
+  def _simplify(self):
+    minuend = self.minuend.simplify()
+    subtrahend = self.subtrahend.simplify()
+    if isinstance(minuend, Number) and isinstance(subtrahend, Number):
+      folded = _fold(operator.sub, minuend, subtrahend)
+      if folded is not None:
+        return folded
+    if _is_number(subtrahend, 0):
+      return minuend
+    if _is_number(minuend, 0):
+      return Negative.of(subtrahend).simplify()
+    if minuend == subtrahend:
+      return NUMBER_ZERO
+    return Difference.of(minuend, subtrahend)
 
 
 class Negative(Expression):
+  __slots__ = ("expression",)
+  _opcode = NEG
+
   def __init__(self, expression):
     self.expression = expression
+    self.var_mask = expression.var_mask
 
-  def evaluate(self, **bindings):
-    return -self.expression.evaluate(**bindings)
-  
-  def expand(self):
-    return Negative(self.expression.expand())
-  
-  def derivative(self, variable):
-    return Negative(self.expression.derivative(variable))
-  
-  def get_distinct_functions(self):
-    return self.expression.get_distinct_functions()
-  
-  def get_distinct_numbers(self):
-    return self.expression.get_distinct_numbers()
+  def __str__(self):
+    return f"-{self.expression}"
+
+  def _key(self):
+    return (self.expression,)
+
+  def _children(self):
+    return (self.expression,)
+
+  def _expand(self):
+    return Negative.of(self.expression if self.expression.is_atomic else self.expression.expand())
   
-  def get_distinct_variables(self):
-    return self.expression.get_distinct_variables()
+  def _derivative(self, variable):
+    return Negative.of(self.expression._derivative_by_id(variable))
   
+  def _simplify(self):
+    expression = self.expression.simplify()
+    if isinstance(expression, Number):
+      return Number.of(-expression.value)
+    if isinstance(expression, Negative):
+      return expression.expression
+    return Negative.of(expression)
+
 
 class AbsoluteValue(Expression):
+  __slots__ = ("expression",)
+  _opcode = ABS
+
   def __init__(self, expression):
     self.expression = expression
+    self.var_mask = expression.var_mask
 
-  def evaluate(self, **bindings):
-    return abs(self.expression.evaluate(**bindings))
-  
-  def expand(self):
-    return AbsoluteValue(self.expression.expand())
-  
-  def derivative(self, variable):
-    return AbsoluteValue(self.expression.derivative(variable))
-  
-  def get_distinct_functions(self):
-    return self.expression.get_distinct_functions()
-  
-  def get_distinct_numbers(self):
-    return self.expression.get_distinct_numbers()
+  def __str__(self):
+    return f"|{self.expression}|"
+
+  def _key(self):
+    return (self.expression,)
+
+  def _children(self):
+    return (self.expression,)
+
+  def _expand(self):
+    return AbsoluteValue.of(self.expression if self.expression.is_atomic else self.expression.expand())
   
-  def get_distinct_variables(self):
-    return self.expression.get_distinct_variables()
+  def _derivative(self, variable):
+    return Product.of(Quotient.of(self.expression, AbsoluteValue.of(self.expression)), self.expression._derivative_by_id(variable))
   
+  def _simplify(self):
+    expression = self.expression.simplify()
+    if isinstance(expression, Number):
+      return Number.of(abs(expression.value))
+    return AbsoluteValue.of(expression)
+
 
 class SquareRoot(Expression):
+  __slots__ = ("expression",)
+  _opcode = SQRT
+
   def __init__(self, expression):
     self.expression = expression
+    self.var_mask = expression.var_mask
 
-  def evaluate(self, **bindings):
-    return self.expression.evaluate(**bindings) ** 0.5
-  
-  def expand(self):
-    return SquareRoot(self.expression.expand())
-  
-  def get_distinct_functions(self):
-    return self.expression.get_distinct_functions()
-  
-  def get_distinct_numbers(self):
-    return self.expression.get_distinct_numbers()
-  
-  def get_distinct_variables(self):
-    return self.expression.get_distinct_variables()
+  def __str__(self):
+    return f"sqrt({self.expression})"
+
+  def _key(self):
+    return (self.expression,)
+
+  def _children(self):
+    return (self.expression,)
+
+  def _expand(self):
+    return SquareRoot.of(self.expression if self.expression.is_atomic else self.expression.expand())
+
+  def _derivative(self, variable):
+    return Quotient.of(self.expression._derivative_by_id(variable), Product.of(Number.of(2), self))
   
+  def _simplify(self):
+    expression = self.expression.simplify()
+    if isinstance(expression, Number):
+      folded = _fold(math.sqrt, expression)
+      if folded is not None:
+        return folded
+    return SquareRoot.of(expression)
+
 
 class Modulo(Expression):
+  __slots__ = ("dividend", "divisor")
+  _opcode = MOD
+
   def __init__(self, dividend, divisor):
     self.dividend = dividend
     self.divisor = divisor
+    self.var_mask = dividend.var_mask | divisor.var_mask
 
-  def evaluate(self, **bindings):
-    return self.dividend.evaluate(**bindings) % self.divisor.evaluate(**bindings)
-  
-  def get_distinct_functions(self):
-    return self.dividend.get_distinct_functions().union(self.divisor.get_distinct_functions())
-  
-  def get_distinct_numbers(self):
-    return self.dividend.get_distinct_numbers().union(self.divisor.get_distinct_numbers())
+  def __str__(self):
+    return f"({self.dividend} % {self.divisor})"
+
+  def _key(self):
+    return (self.dividend, self.divisor)
+
+  def _children(self):
+    return (self.dividend, self.divisor)
+
+  def _expand(self):
+    return Modulo.of(self.dividend if self.dividend.is_atomic else self.dividend.expand(), self.divisor if self.divisor.is_atomic else self.divisor.expand())
+
+  def _derivative(self, variable):
+    return Difference.of(self.dividend._derivative_by_id(variable), Product.of(Apply.of(Function("floor"), Quotient.of(self.dividend, self.divisor)), self.divisor._derivative_by_id(variable)))
   
-  def get_distinct_variables(self):
-    return self.dividend.get_distinct_variables().union(self.divisor.get_distinct_variables())
+  def _simplify(self):
+    dividend = self.dividend.simplify()
+    divisor = self.divisor.simplify()
+    if isinstance(dividend, Number) and isinstance(divisor, Number):
+      folded = _fold(operator.mod, dividend, divisor)
+      if folded is not None:
+        return folded
+    return Modulo.of(dividend, divisor)
 
 
 class Function():
+  __slots__ = ("name",)
+
   def __init__(self, name):
     self.name = name
 
@@ -353,26 +1105,75 @@ class Function():
     return set()
   
 
+_SPECIAL_FUNCTIONS_DERIVATIVES = {
+  "sin": lambda u: Apply.of(Function("cos"), u),
+  "cos": lambda u: Negative.of(Apply.of(Function("sin"), u)),
+  "tan": lambda u: Quotient.of(NUMBER_ONE, Power.of(Apply.of(Function("cos"), u), Number.of(2))),
+  "asin": lambda u: Quotient.of(NUMBER_ONE, SquareRoot.of(Difference.of(NUMBER_ONE, Power.of(u, Number.of(2))))),
+  "acos": lambda u: Negative.of(Quotient.of(NUMBER_ONE, SquareRoot.of(Difference.of(NUMBER_ONE, Power.of(u, Number.of(2)))))),
+  "atan": lambda u: Quotient.of(NUMBER_ONE, Sum.of(NUMBER_ONE, Power.of(u, Number.of(2)))),
+  "sinh": lambda u: Apply.of(Function("cosh"), u),
+  "cosh": lambda u: Apply.of(Function("sinh"), u),
+  "tanh": lambda u: Difference.of(NUMBER_ONE, Power.of(Apply.of(Function("tanh"), u), Number.of(2))),
+  "asinh": lambda u: Quotient.of(NUMBER_ONE, SquareRoot.of(Sum.of(Power.of(u, Number.of(2)), NUMBER_ONE))),
+  "acosh": lambda u: Quotient.of(NUMBER_ONE, SquareRoot.of(Difference.of(Power.of(u, Number.of(2)), NUMBER_ONE))),
+  "atanh": lambda u: Quotient.of(NUMBER_ONE, Difference.of(NUMBER_ONE, Power.of(u, Number.of(2)))),
+  "exp": lambda u: Apply.of(Function("exp"), u),
+  "ln": lambda u: Quotient.of(NUMBER_ONE, u),
+  "log": lambda u: Quotient.of(NUMBER_ONE, Product.of(u, Number.of(math.log(10)))),
+  "sqrt": lambda u: Quotient.of(NUMBER_ONE, Product.of(Number.of(2), Apply.of(Function("sqrt"), u))),
+  "abs": lambda u: Quotient.of(u, Apply.of(Function("abs"), u)),
+  "ceil": lambda u: NUMBER_ZERO,
+  "floor": lambda u: NUMBER_ZERO,
+}
+
+
 class Apply(Expression):
+  __slots__ = ("function", "argument")
+  _opcode = CALL_FN
+
   def __init__(self, function, argument):
     self.function = function
     self.argument = argument
+    self.var_mask = argument.var_mask
 
-  def evaluate(self, **bindings):
-    return _SPECIAL_FUNCTIONS_BINDING[self.function.name](self.argument.evaluate(**bindings))
-  
-  def expand(self):
-    return Apply(self.function, self.argument.expand())
-  
-  def get_distinct_functions(self):
-    return {self.function.name}.union(self.argument.get_distinct_functions())
-  
-  def get_distinct_numbers(self):
-    return self.argument.get_distinct_numbers()
-  
-  def get_distinct_variables(self):
-    return self.argument.get_distinct_variables()
+  def __str__(self):
+    return f"{self.function.name}({self.argument})"
+
+  def _key(self):
+    return (self.function.name, self.argument)
+
+  @classmethod
+  def _key_of(cls, function, argument):
+    return (function.name, argument)
+
+  def _children(self):
+    return (self.argument,)
+
+  def _collect(self, vars_out, nums_out, fns_out):
+    fns_out.add(self.function.name)
+
+  def _expand(self):
+    return Apply.of(self.function, self.argument if self.argument.is_atomic else self.argument.expand())
+
+  def _derivative(self, variable):
+    argument_derivative = self.argument._derivative_by_id(variable)
+    if _is_number(argument_derivative, 0):
+      return argument_derivative
+    try:
+      outer = _SPECIAL_FUNCTIONS_DERIVATIVES[self.function.name]
+    except KeyError:
+      raise ValueError(f"Function {self.function.name} has no known derivative")
+    return Product.of(outer(self.argument), argument_derivative)
   
+  def _simplify(self):
+    argument = self.argument.simplify()
+    function = _SPECIAL_FUNCTIONS_BINDING.get(self.function.name)
+    if function is not None and isinstance(argument, Number):
+      folded = _fold(function, argument)
+      if folded is not None:
+        return folded
+    return Apply.of(self.function, argument)
 
 
 
@@ -380,10 +1181,10 @@ def distinct_functions(expression):
   return expression.get_distinct_functions()
 
 def expression_contain_combinator(expression, combinator):
-  if isinstance(expression, combinator):
-    return True
-  elif isinstance(expression, Expression):
-    return any(expression_contain_combinator(sub_expression, combinator) for sub_expression in expression.__dict__.values())
-  else:
+  if not isinstance(expression, Expression):
     raise TypeError("expression must be an instance of Expression")
+  return any(
+    isinstance(node, combinator) or (isinstance(node, Apply) and isinstance(node.function, combinator))
+    for node in expression._walk()
+  )
   
\ No newline at end of file
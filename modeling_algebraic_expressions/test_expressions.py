@@ -0,0 +1,391 @@
+import gc
+import math
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from expressions import (
+  AbsoluteValue, Apply, BoundExpression, Difference, Function, Modulo, Negative, Number, NUMBER_ONE, NUMBER_ZERO, Power, Product,
+  Quotient, SquareRoot, Sum, Variable, compile_jit, compile_schedule, distinct_functions, expression_contain_combinator,
+  _JIT_CACHE, _schedule_cython_source,
+)
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+try:
+  from pyximport import pyxbuild
+except ImportError:
+  pyxbuild = None
+
+
+x = Variable.of("x")
+y = Variable.of("y")
+
+
+def sin(argument):
+  return Apply.of(Function("sin"), argument)
+
+
+def shared_dag(depth):
+  expression = x
+  for _ in range(depth):
+    expression = Product.of(Sum.of(expression, NUMBER_ONE), expression)
+  return expression
+
+
+class EvaluateTest(unittest.TestCase):
+  def test_polynomial(self):
+    expression = Sum.of(Product.of(Number.of(3), Power.of(x, Number.of(2))), Difference.of(x, NUMBER_ONE))
+    self.assertEqual(expression.evaluate(x=2), 13)
+
+  def test_every_node_type(self):
+    expression = Sum.of(
+      Quotient.of(y, x), Negative.of(AbsoluteValue.of(y)), Modulo.of(x, Number.of(3)), sin(x), SquareRoot.of(x),
+    )
+    expected = 3 / 4 - 3 + 1 + math.sin(4) + 2
+    self.assertAlmostEqual(expression.evaluate(x=4, y=3), expected)
+
+  def test_unbound_variable(self):
+    with self.assertRaises(ValueError):
+      Sum.of(x, y).evaluate(x=1)
+
+  def test_compile(self):
+    expression = Sum.of(Product.of(x, y), x)
+    program = expression.compile()
+    self.assertIs(program, compile_schedule(expression))
+    self.assertEqual(program(x=2, y=3), 8)
+    self.assertEqual(program(x=1, y=1), 2)
+
+  def test_shared_subtrees_are_computed_once(self):
+    program = compile_schedule(shared_dag(40))
+    self.assertEqual(len(program.schedule), 81)
+    self.assertEqual(program(x=0), 0)
+    self.assertEqual(shared_dag(3).evaluate(x=2), 1806)
+
+  def test_signed_zero_constants(self):
+    program = compile_schedule(Sum.of(Quotient.of(x, Number.of(0.0)), Quotient.of(x, Number.of(-0.0))))
+    self.assertEqual([math.copysign(1.0, value) for value in program.values if value == 0], [1.0, -1.0])
+
+  def test_str(self):
+    self.assertEqual(str(Sum.of(Product.of(Number.of(3), x), sin(y))), "((3 * x) + sin(y))")
+
+
+class SimplifyTest(unittest.TestCase):
+  def test_constant_folding(self):
+    self.assertEqual(Power.of(Number.of(2), Number.of(3)).simplify(), Number.of(8))
+    self.assertEqual(Sum.of(NUMBER_ONE, Number.of(2), x).simplify(), Sum.of(x, Number.of(3)))
+
+  def test_identities(self):
+    self.assertIs(Product.of(x, NUMBER_ZERO).simplify(), NUMBER_ZERO)
+    self.assertIs(Product.of(x, NUMBER_ONE).simplify(), x)
+    self.assertIs(Sum.of(x, NUMBER_ZERO).simplify(), x)
+    self.assertIs(Difference.of(x, x).simplify(), NUMBER_ZERO)
+    self.assertIs(Power.of(x, NUMBER_ONE).simplify(), x)
+    self.assertIs(Power.of(x, NUMBER_ZERO).simplify(), NUMBER_ONE)
+
+  def test_division_by_zero_is_not_folded(self):
+    self.assertIsInstance(Quotient.of(NUMBER_ONE, NUMBER_ZERO).simplify(), Quotient)
+
+  def test_double_negation(self):
+    self.assertIs(Difference.of(NUMBER_ZERO, Negative.of(x)).simplify(), x)
+
+  def test_shared_subtrees_are_simplified_once(self):
+    expression = shared_dag(40)
+    self.assertIs(expression.simplify(), expression.simplify())
+
+  def test_unknown_functions_are_not_folded(self):
+    for name in ("foo", "atan2"):
+      applied = Apply.of(Function(name), NUMBER_ONE)
+      self.assertIs(Sum.of(applied, x).expand(), Sum.of(applied, x))
+      self.assertIs(Sum.of(applied, x).derivative("x"), NUMBER_ONE)
+
+
+  def test_square_root_identities(self):
+    root = SquareRoot.of(x)
+    self.assertIs(Power.of(root, Number.of(2)).simplify(), x)
+    self.assertIs(Product.of(root, root).simplify(), x)
+    self.assertIs(SquareRoot.of(Number.of(-4)).simplify(), SquareRoot.of(Number.of(-4)))
+
+
+class DerivativeTest(unittest.TestCase):
+  def test_product_rule(self):
+    expression = Product.of(Power.of(x, Number.of(3)), y)
+    self.assertEqual(expression.derivative("x").evaluate(x=2, y=5), 60)
+
+  def test_variable_exponent(self):
+    self.assertAlmostEqual(Power.of(Number.of(2), x).derivative("x").evaluate(x=1), 2 * math.log(2))
+    self.assertAlmostEqual(Power.of(x, x).derivative("x").evaluate(x=2), 4 * (1 + math.log(2)))
+
+  def test_quotient_rule(self):
+    expression = Quotient.of(x, Sum.of(x, NUMBER_ONE))
+    self.assertAlmostEqual(expression.derivative("x").evaluate(x=1), 0.25)
+
+  def test_chain_rule(self):
+    expression = sin(Power.of(x, Number.of(2)))
+    self.assertAlmostEqual(expression.derivative("x").evaluate(x=1.5), 3 * math.cos(2.25))
+
+  def test_absolute_value(self):
+    self.assertEqual(AbsoluteValue.of(x).derivative("x").evaluate(x=-2), -1)
+    self.assertIs(AbsoluteValue.of(x).derivative("x"), Quotient.of(x, AbsoluteValue.of(x)))
+    self.assertEqual(Apply.of(Function("abs"), x).derivative("x").evaluate(x=-2), -1)
+
+  def test_shared_subtrees(self):
+    expression = shared_dag(40)
+    self.assertIs(expression.derivative("x"), expression.derivative("x"))
+    expression = shared_dag(4)
+    slope = (expression.evaluate(x=0.3 + 1e-6) - expression.evaluate(x=0.3 - 1e-6)) / 2e-6
+    self.assertAlmostEqual(expression.derivative("x").evaluate(x=0.3), slope, places=5)
+
+  def test_square_root(self):
+    self.assertAlmostEqual(SquareRoot.of(x).derivative("x").evaluate(x=4), 0.25)
+
+  def test_variable_or_name(self):
+    expression = Product.of(Power.of(x, Number.of(3)), y)
+    self.assertIs(expression.derivative(x), expression.derivative("x"))
+    self.assertIs(x.derivative("z"), NUMBER_ZERO)
+    self.assertTrue(expression.contains(y))
+
+  def test_independent_subtree(self):
+    expression = Sum.of(sin(y), Power.of(y, x))
+    self.assertIs(sin(y).derivative("x"), NUMBER_ZERO)
+    self.assertEqual(expression.var_mask, x.var_mask | y.var_mask)
+    self.assertFalse(sin(y).contains("x"))
+    self.assertTrue(expression.contains("x"))
+    self.assertAlmostEqual(Power.of(x, y).derivative("x").evaluate(x=2, y=3), 12)
+
+  def test_rejects_symbol_ids(self):
+    with self.assertRaises(TypeError):
+      x.derivative(0)
+    with self.assertRaises(TypeError):
+      NUMBER_ONE.derivative(0)
+    with self.assertRaises(TypeError):
+      x.contains(0)
+
+  def test_modulo(self):
+    self.assertEqual(Modulo.of(x, Number.of(3)).derivative("x").evaluate(x=4), 1)
+
+  def test_unknown_function(self):
+    with self.assertRaises(ValueError):
+      Apply.of(Function("foo"), x).derivative("x")
+
+
+class ExpandTest(unittest.TestCase):
+  def test_distributes_products(self):
+    expanded = Product.of(Sum.of(x, NUMBER_ONE), Sum.of(x, Number.of(2))).expand()
+    self.assertIsInstance(expanded, Sum)
+    self.assertTrue(expanded.is_expanded)
+    self.assertIs(expanded.expand(), expanded)
+    self.assertEqual(expanded.evaluate(x=3), 20)
+
+  def test_expansion_is_cached(self):
+    expression = Product.of(Sum.of(x, NUMBER_ONE), Sum.of(x, Number.of(2)))
+    expanded = expression.expand()
+    self.assertIs(expression.expand(), expanded)
+    self.assertTrue(x.is_atomic)
+    self.assertFalse(expression.is_atomic)
+    self.assertIs(x.expand(), x)
+    self.assertIsNone(x._expanded)
+
+  def test_exponent_sum(self):
+    expanded = Power.of(x, Sum.of(NUMBER_ONE, y)).expand()
+    self.assertIsInstance(expanded, Product)
+    self.assertEqual(expanded.evaluate(x=2, y=3), 16)
+
+  def test_merged_square_roots_are_expanded(self):
+    expression = Product.of(SquareRoot.of(Sum.of(x, y)), SquareRoot.of(x))
+    expression.simplify()
+    expanded = expression.expand()
+    self.assertIs(expanded, SquareRoot.of(Sum.of(Product.of(x, x), Product.of(y, x))))
+    self.assertIs(expanded.expand(), expanded)
+    paired = Product.of(SquareRoot.of(Sum.of(x, y)), SquareRoot.of(Sum.of(x, y)), Variable.of("z")).expand()
+    self.assertIsInstance(paired, Sum)
+    self.assertAlmostEqual(paired.evaluate(x=2, y=3, z=5), 25)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class EvaluateArrayTest(unittest.TestCase):
+  def test_matches_evaluate(self):
+    expression = Sum.of(Power.of(x, Number.of(2)), sin(x), Quotient.of(y, Sum.of(x, NUMBER_ONE)), SquareRoot.of(x))
+    values = np.linspace(0, 2, 5)
+    expected = [expression.evaluate(x=float(value), y=3.0) for value in values]
+    np.testing.assert_allclose(expression.evaluate_array(x=values, y=3.0), expected)
+
+  def test_integer_input(self):
+    derivative = Power.of(x, Number.of(-1)).derivative("x")
+    values = np.arange(1, 5)
+    expected = [derivative.evaluate(x=int(value)) for value in values]
+    np.testing.assert_allclose(derivative.evaluate_array(x=values), expected)
+
+  def test_constant_is_broadcast(self):
+    values = np.linspace(0, 2, 5)
+    result = Product.of(Number.of(3), x).derivative("x").evaluate_array(x=values)
+    self.assertEqual(result.shape, values.shape)
+    np.testing.assert_array_equal(result, np.full(5, 3.0))
+
+
+class BindTest(unittest.TestCase):
+  def test_bind(self):
+    bound = Sum.of(Quotient.of(y, x), x).bind(["y", "x"])
+    self.assertIsInstance(bound, BoundExpression)
+    self.assertEqual(bound(4, 2), 4)
+    self.assertEqual(bound.evaluate(x=2, y=4), 4)
+    with self.assertRaises(TypeError):
+      bound(1)
+    with self.assertRaises(ValueError):
+      bound.evaluate(x=2)
+    with self.assertRaises(ValueError):
+      x.bind(["y"])
+
+  def test_bind_shared_subtrees(self):
+    expression = shared_dag(40)
+    bound = expression.bind(["x"])
+    self.assertEqual(bound(-0.5), expression.evaluate(x=-0.5))
+
+  @unittest.skipIf(np is None, "numpy is not installed")
+  def test_arrays(self):
+    bound = Quotient.of(y, x).bind(["x", "y"])
+    values = np.arange(1, 5)
+    np.testing.assert_allclose(bound.evaluate_array(x=values, y=values), np.ones(4))
+    np.testing.assert_allclose(bound.call_array(values, values), np.ones(4))
+    np.testing.assert_array_equal(NUMBER_ONE.bind(["x"]).call_array(values), np.ones(4))
+
+
+class JitTest(unittest.TestCase):
+  def test_to_jit(self):
+    expression = Sum.of(Quotient.of(y, x), x)
+    function = expression.to_jit(["y", "x"])
+    self.assertIs(function, compile_jit(expression, ["y", "x"]))
+    self.assertEqual(function(4.0, 2.0), 4.0)
+    self.assertEqual(SquareRoot.of(x).to_jit(["x"])(9.0), 3.0)
+    with self.assertRaises(ValueError):
+      x.to_jit(["y"])
+
+  def test_non_finite_constants(self):
+    function = compile_jit(Sum.of(Product.of(x, Number.of(math.inf)), Number.of(-math.inf)), ["x"])
+    self.assertTrue(math.isnan(function(1.0)))
+    self.assertEqual(compile_jit(Quotient.of(NUMBER_ONE, Sum.of(x, Number.of(math.inf))), ["x"])(1.0), 0)
+
+  def test_rejects_unknown_functions_and_values(self):
+    with self.assertRaises(ValueError):
+      compile_jit(Apply.of(Function("(lambda v: print('INJECTED', v))"), x), ["x"])
+    with self.assertRaises(ValueError):
+      compile_jit(Sum.of(x, Number.of("__import__('os')")), ["x"])
+
+  def test_cache_does_not_keep_roots_alive(self):
+    compile_jit(Sum.of(x, Number.of(17)), ["x"])
+    gc.collect()
+    self.assertNotIn(Sum.of(x, Number.of(17)), _JIT_CACHE)
+
+
+class CythonTest(unittest.TestCase):
+  def test_non_finite_constants(self):
+    source = _schedule_cython_source(compile_schedule(Sum.of(x, Number.of(-math.inf), Number.of(math.nan))), ["x"])
+    self.assertIn("(-INFINITY)", source)
+    self.assertIn("NAN", source)
+    self.assertNotIn("inf)", source)
+
+  def test_rejects_unknown_functions(self):
+    with self.assertRaises(ValueError):
+      _schedule_cython_source(compile_schedule(Apply.of(Function("foo"), x)), ["x"])
+    with tempfile.TemporaryDirectory() as cache, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache}):
+      with self.assertRaises(ValueError):
+        Apply.of(Function("foo"), x).to_c_extension(["x"])
+      self.assertEqual(os.listdir(cache), [])
+
+  @unittest.skipIf(pyxbuild is None, "Cython is not installed")
+  def test_c_extension(self):
+    with tempfile.TemporaryDirectory() as cache, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache}):
+      function = Sum.of(Product.of(x, y), Number.of(0.5)).to_c_extension(["x", "y"])
+      self.assertNotIsInstance(function, BoundExpression)
+      self.assertEqual(function(2.0, 3.0), 6.5)
+      self.assertEqual(os.stat(os.path.join(cache, "calculus_cython")).st_mode & 0o777, 0o700)
+
+  @unittest.skipIf(pyxbuild is None, "Cython is not installed")
+  def test_c_extension_rejects_shared_cache(self):
+    with tempfile.TemporaryDirectory() as cache, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache}):
+      os.mkdir(os.path.join(cache, "calculus_cython"), 0o777)
+      os.chmod(os.path.join(cache, "calculus_cython"), 0o777)
+      with self.assertWarns(RuntimeWarning):
+        function = Sum.of(Product.of(x, y), Number.of(0.25)).to_c_extension(["x", "y"])
+      self.assertIsInstance(function, BoundExpression)
+      self.assertEqual(function(2.0, 3.0), 6.25)
+      self.assertEqual(os.listdir(os.path.join(cache, "calculus_cython")), [])
+
+  @unittest.skipIf(pyxbuild is not None, "Cython is installed")
+  def test_falls_back_to_bind(self):
+    function = Sum.of(Product.of(x, y), Number.of(0.5)).to_c_extension(["x", "y"])
+    self.assertIsInstance(function, BoundExpression)
+    self.assertEqual(function(2.0, 3.0), 6.5)
+
+
+class QueryTest(unittest.TestCase):
+  def test_distinct_values(self):
+    expression = Sum.of(Product.of(Number.of(3), x), sin(y), Number.of(2))
+    self.assertEqual(expression.get_distinct_variables(), {"x", "y"})
+    self.assertEqual(expression.get_distinct_numbers(), {2, 3})
+    self.assertEqual(distinct_functions(expression), {"sin"})
+    self.assertTrue(expression.contains("y"))
+    self.assertFalse(expression.contains("z"))
+
+  def test_contain_combinator(self):
+    expression = Sum.of(x, sin(y))
+    self.assertTrue(expression_contain_combinator(expression, Apply))
+    self.assertTrue(expression_contain_combinator(expression, Function))
+    self.assertFalse(expression_contain_combinator(expression, Quotient))
+    self.assertFalse(expression_contain_combinator(shared_dag(60), Quotient))
+    with self.assertRaises(TypeError):
+      expression_contain_combinator(Function("sin"), Apply)
+
+  def test_distinct_values_of_shared_subtrees(self):
+    self.assertEqual(shared_dag(60).get_distinct_numbers(), {1})
+
+  def test_collect_all(self):
+    expression = Sum.of(Product.of(Number.of(3), x), sin(y))
+    collected = expression.collect_all()
+    self.assertEqual(collected, (frozenset({"x", "y"}), frozenset({3}), frozenset({"sin"})))
+    self.assertIs(expression.collect_all(), collected)
+    expression.get_distinct_variables().add("z")
+    self.assertEqual(expression.get_distinct_variables(), {"x", "y"})
+
+  def test_variadic_constructors(self):
+    self.assertIs(Product.of(), NUMBER_ONE)
+    self.assertIs(Product.of(x), x)
+    product = Product.of(x, y, x, y)
+    self.assertIs(product.factor1, Product.of(x, y))
+    self.assertIs(product.factor2, Product.of(x, y))
+    self.assertEqual(Sum.of(Sum.of(x, y), NUMBER_ONE).terms, (x, y, NUMBER_ONE))
+
+  def test_hash_consing(self):
+    self.assertIs(Sum.of(x, y), Sum.of(x, y))
+    self.assertEqual(Sum(x, y), Sum.of(x, y))
+    self.assertIsNot(Number.of(1.0), NUMBER_ONE)
+
+  def test_of_returns_cached_node_without_constructing(self):
+    expression = Sum.of(x, y)
+    constructed = []
+    original = Sum.__init__
+    Sum.__init__ = lambda self, *terms: constructed.append(terms) or original(self, *terms)
+    try:
+      self.assertIs(Sum.of(x, y), expression)
+    finally:
+      Sum.__init__ = original
+    self.assertEqual(constructed, [])
+
+  def test_slots(self):
+    self.assertFalse(hasattr(Sum.of(x, y), "__dict__"))
+    self.assertEqual(Power(base=x, exponent=y), Power.of(x, y))
+    self.assertEqual(Apply(function=Function("sin"), argument=x), sin(x))
+
+  def test_signed_zeros_are_distinct(self):
+    negative = Number.of(-0.0)
+    self.assertEqual(str(Number.of(0.0)), "0.0")
+    self.assertIsNot(Number.of(0.0), negative)
+    self.assertNotEqual(Number.of(0.0), negative)
+
+
+if __name__ == "__main__":
+  unittest.main()